@@ -7,8 +7,13 @@ analyze_rank_movers.py
   - 輸出：movers_YYYYMMDD.json (YYYYMMDD 為較新的日期)
 """
 
-import os, json, pathlib, datetime
-from collections import defaultdict
+import os, heapq, mmap, pathlib, datetime
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import pairwise
+from operator import itemgetter
+
+import orjson
 
 # --- 路徑與常數設定 (修正後的地圖) ---
 BASE_DIR = pathlib.Path(".").resolve() 
@@ -19,13 +24,15 @@ MOVERS_DIR.mkdir(parents=True, exist_ok=True)
 TARGET_COUNTRIES = ["TW", "US", "CN", "TH", "PH"]
 TARGET_CHARTS = ["top_grossing", "top_free"]
 PLATFORMS = ["ios", "gp"] 
+MAX_WORKERS = 16 # 平行載入榜單檔案的執行緒數
+MMAP_THRESHOLD = 64 * 1024 # 榜單檔案超過此大小 (bytes) 時改用 mmap 讀取
+MOVERS_DUMP_OPTIONS = orjson.OPT_INDENT_2 | orjson.OPT_APPEND_NEWLINE | orjson.OPT_NON_STR_KEYS
 
 # --- 工具函式 ---
 def read_json(path):
     """安全讀取 JSON 檔案，不存在或錯誤則回傳空字典"""
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
+        return orjson.loads(pathlib.Path(path).read_bytes())
     except Exception:
         return {}
 
@@ -36,59 +43,87 @@ def load_available_dates(country: str):
     data = read_json(path)
     return data if isinstance(data, list) else []
 
+def _rank_path(country, date_str, chart, platform="ios"):
+    """指定國家、日期、榜單與平台的排行榜檔案路徑"""
+    return RANKS_DIR / country / f"{platform.lower()}_{country.lower()}_{chart}_{date_str}.json"
+
+@lru_cache(maxsize=None)
 def load_rank(country, date_str, chart, platform="ios"):
-    """載入指定國家、日期、榜單與平台的排行榜 JSON 檔案。"""
-    prefix = platform.lower()
-    path = RANKS_DIR / country / f"{prefix}_{country.lower()}_{chart}_{date_str}.json"
-    if not path.exists():
-        return None
+    """
+    載入指定國家、日期、榜單與平台的排行榜 JSON 檔案。
+    同一檔案會先後作為「今日」與「昨日」被讀取，因此快取解析結果 (呼叫端不可修改回傳值)。
+    """
+    path = _rank_path(country, date_str, chart, platform)
+    # 檔案不存在時 open 會拋出 FileNotFoundError，不需另外以 exists() 檢查
     try:
-        return json.load(open(path, encoding="utf-8"))
+        with open(path, "rb") as f:
+            # 小檔案直接讀取；大檔案以 mmap 映射後交給 orjson 解析，省去一次複製
+            if os.fstat(f.fileno()).st_size < MMAP_THRESHOLD:
+                return orjson.loads(f.read())
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as buf:
+                return orjson.loads(buf)
     except Exception:
         return None
 
+@lru_cache(maxsize=None)
+def load_prev_map(country, date_str, chart, platform="ios"):
+    """載入指定榜單並建立 app_id 到 rank 的映射，數據缺失則回傳 None"""
+    data = load_rank(country, date_str, chart, platform)
+    if not data:
+        return None
+    return {r["app_id"]: r["rank"] for r in data["rows"]}
+
 def analyze_date_pair_movers(country, chart, platform, today_str, yesterday_str):
     """比較特定日期對的榜單，找出名次大幅變動者"""
     
-    today_data = load_rank(country, today_str, chart, platform)
-    yesterday_data = load_rank(country, yesterday_str, chart, platform)
+    # 任一天的榜單檔案不存在就直接跳過，不解析另一天的檔案，也不在快取中留下單邊結果
+    if not (_rank_path(country, today_str, chart, platform).exists()
+            and _rank_path(country, yesterday_str, chart, platform).exists()):
+        return []
+    
+    # 先取昨日 app_id 到 rank 的映射 (已快取)，缺失時不必再解析今日榜單
+    prev_map = load_prev_map(country, yesterday_str, chart, platform)
+    if prev_map is None:
+        return []
     
-    if not today_data or not yesterday_data:
+    today_data = load_rank(country, today_str, chart, platform)
+    if not today_data:
         # 如果任一天數據缺失，則跳過
         return []
 
-    # 建立昨日 app_id 到 rank 的映射
-    prev_map = {r["app_id"]: r["rank"] for r in yesterday_data["rows"]}
     movers = []
     
     for r in today_data["rows"]:
-        aid = r["app_id"]
-        # 僅考慮昨日存在榜單上的 app
-        if aid not in prev_map:
+        # 僅考慮昨日存在榜單上的 app (單次查表取得昨日名次)
+        prev_rank = prev_map.get(r["app_id"])
+        if prev_rank is None:
             continue
             
-        delta = prev_map[aid] - r["rank"]
+        delta = prev_rank - r["rank"]
+        abs_delta = -delta if delta < 0 else delta
         
-        # 名次變動絕對值大於等於 10 才記錄
-        if abs(delta) >= 10:
-            movers.append({
+        # 名次變動絕對值大於等於 10 才記錄 (絕對值與 mover 成對保存，排序時不必重算)
+        if abs_delta >= 10:
+            movers.append((abs_delta, {
                 "name": r["app_name"],
                 "delta": delta,
                 "direction": "rise" if delta > 0 else "fall"
-            })
+            }))
 
-    # 依變動幅度絕對值排序，取 Top 10
-    movers.sort(key=lambda x: -abs(x["delta"]))
-    return movers[:10]
+    # 依變動幅度絕對值取 Top 10 (部分排序，不需排序整個列表)
+    return [mover for _, mover in heapq.nlargest(10, movers, key=itemgetter(0))]
 
 def main():
-    # 最終輸出結果結構: { date_str: { country: { chart: { platform_chart: [movers] } } } }
-    # 這裡將 all_results 的結構調整為 { date_str: { country: { platform: { chart: [movers] } } } }
+    # 收集時使用扁平結構: { (date_str, country, platform, chart): [movers] }
+    # 輸出前再一次組成 { date_str: { country: { platform: { chart: [movers] } } } }
     # 以便於儲存時能正確區分平台和榜單
-    all_results = defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: defaultdict(list)))) 
+    all_results = {}
 
     print("=== 開始分析歷史名次變動 (Movers) ===")
     
+    # 先列出所有 (國家, 日期對, 平台, 榜單) 任務，再交給執行緒池平行載入與比對
+    tasks = []
+    
     for cc in TARGET_COUNTRIES:
         
         dates = load_available_dates(cc)
@@ -96,52 +131,50 @@ def main():
             print(f"[WARN] {cc}: 缺少足夠的可用日期 (至少需要 2 天)，跳過。")
             continue
             
-        print(f"\n--- 處理 {cc} ({len(dates)} 個可用日期) ---")
+        print(f"--- 排入 {cc} ({len(dates)} 個可用日期) ---")
         
-        # 遍歷所有可比較的日期對 (dates[i] vs dates[i+1])
-        for i in range(len(dates) - 1):
-            today_str = dates[i]    # 較新的日期
-            yesterday_str = dates[i+1] # 較舊的日期
+        # 遍歷所有可比較的日期對 (較新的日期 today_str vs 較舊的日期 yesterday_str)
+        for today_str, yesterday_str in pairwise(dates):
           
             # 由於我們要輸出包含 ios/gp 的綜合結果，建議先手動刪除 data/movers/ 下舊的 movers_YYYYMMDD.json
-            out_path = MOVERS_DIR / f"movers_{today_str}.json"
-            # 為了確保涵蓋 GP 數據，如果檔案已存在，我們仍然會重新計算，但這裡先註釋掉跳過邏輯。
-            # if out_path.exists():
-            #     print(f"[SKIP] {cc}: movers_{today_str}.json 已存在，跳過計算。")
-            #     continue
+            # 為了確保涵蓋 GP 數據，如果檔案已存在，我們仍然會重新計算，因此不跳過已存在的 movers_YYYYMMDD.json。
             
             for platform in PLATFORMS:
                 
                 for chart in TARGET_CHARTS:
-                    
-                    movers = analyze_date_pair_movers(cc, chart, platform, today_str, yesterday_str)
-                    
-                    if movers:
-                        # 修正：將結果儲存到正確的層級: all_results[date][country][platform][chart]
-                        all_results[today_str][cc.lower()][platform][chart] = movers
-                        print(f"[OK] {cc} {chart} ({platform.upper()}): {len(movers)} movers detected ({today_str} vs {yesterday_str}).")
-                    else:
-                        print(f"[INFO] {cc} {chart} ({platform.upper()}): No movers detected ({today_str} vs {yesterday_str}).")
+                    tasks.append((cc, today_str, yesterday_str, platform, chart))
+
+    # 檔案讀取與 JSON 解析屬 I/O 密集，使用執行緒池平行處理。
+    # 依提交順序取回結果 (而非完成順序)，確保輸出 JSON 的鍵順序固定；all_results 只在主執行緒寫入。
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = [
+            executor.submit(analyze_date_pair_movers, cc, chart, platform, today_str, yesterday_str)
+            for cc, today_str, yesterday_str, platform, chart in tasks
+        ]
+        
+        for (cc, today_str, yesterday_str, platform, chart), future in zip(tasks, futures):
+            movers = future.result()
+            
+            if movers:
+                all_results[(today_str, cc.lower(), platform, chart)] = movers
+                print(f"[OK] {cc} {chart} ({platform.upper()}): {len(movers)} movers detected ({today_str} vs {yesterday_str}).")
+            else:
+                print(f"[INFO] {cc} {chart} ({platform.upper()}): No movers detected ({today_str} vs {yesterday_str}).")
 
 
+    # 依日期組成最終輸出結構: { date_str: { country: { platform: { chart: [movers] } } } }
+    reports = {}
+    for (today_str, country_code, platform, chart), movers in all_results.items():
+        reports.setdefault(today_str, {}).setdefault(country_code, {}).setdefault(platform, {})[chart] = movers
+
     # 輸出所有日期的結果檔案
     generated_files = []
     
-    for today_str, country_data in all_results.items():
+    for today_str, final_result in reports.items():
         
-        # 準備最終輸出結構: { country: { platform: { chart: [movers] } } }
-        final_result = {}
-        for country_code, platform_data in country_data.items():
-            final_result[country_code] = {}
-            for platform, chart_data in platform_data.items():
-                # 將 defaultdict(list) 轉換為標準 dict
-                final_result[country_code][platform] = dict(chart_data)
-
         out_path = MOVERS_DIR / f"movers_{today_str}.json"
-        
-        with open(out_path, "w", encoding="utf-8") as f:
-            json.dump(final_result, f, ensure_ascii=False, indent=2)
-            
+        # 一次序列化成 bytes，單次寫入
+        out_path.write_bytes(orjson.dumps(final_result, option=MOVERS_DUMP_OPTIONS))
         generated_files.append(out_path.name)
     
     print("\n=== Summary ===")
@@ -1,9 +1,9 @@
 import os
-import json
 import datetime
 from pathlib import Path
 from collections import Counter
-import time
+
+import orjson
 
 # === 新增 AI 相關模組 ===
 from openai import OpenAI
@@ -15,9 +15,19 @@ RANKS_DIR = DATA_DIR / "ranks"
 OUTPUT_SUFFIX = "_classified.json"
 # 遊戲類型快取檔案 (讀取與寫入)
 GAME_TYPES_CACHE_PATH = DATA_DIR / "game_types.json"
+# sync_overrides.py 只在人工覆寫改動既有分類時才重寫此檔，用來判斷分類檔是否過期
+# (game_types.json 在 AI 新增分類時也會改寫，不能拿它的修改時間來判斷)
+OVERRIDES_REVISION_PATH = DATA_DIR / ".overrides_revision.json"
 
 # 前端定義的統一 AI 分類 (7 種)，這是 AI 必須回答的唯一選項
 AI_CATEGORIES = ["角色扮演", "社交賭場", "策略對戰", "動作競技", "模擬沙盒", "休閒益智", "其他"]
+# 解析 AI 回答用的查表：分類名稱本身，以及帶提示序號的形式 (例如 "1. 角色扮演")
+AI_CATEGORY_SET = set(AI_CATEGORIES)
+AI_CATEGORY_NUMBERED = {f"{i}. {c}": c for i, c in enumerate(AI_CATEGORIES, start=1)}
+# 單次 API 請求中批次分類的遊戲數量
+AI_BATCH_SIZE = 30
+# 每新增多少筆 AI 分類就先回存一次快取，避免程式中斷時遺失已付費的分類結果
+CACHE_FLUSH_EVERY = 50
 
 # === OpenAI AI 初始化 ===
 # 從 GitHub Actions 傳入的環境變數讀取 API Key
@@ -39,16 +49,17 @@ else:
 def read_json(path):
     """安全讀取 JSON 檔案，不存在或錯誤則回傳空字典"""
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
+        return orjson.loads(Path(path).read_bytes())
     except Exception:
         return {}
 
 def save_json(path, data):
-    """安全寫入 JSON 檔案"""
+    """安全寫入 JSON 檔案 (先寫入暫存檔再以 os.replace 原子性替換，避免中斷時留下殘缺檔案)"""
     try:
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        path = Path(path)
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_bytes(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+        os.replace(tmp_path, path)
         print(f"[INFO] 成功將 {len(data)} 筆快取資料回存至 {path}")
     except Exception as e:
         print(f"[FATAL ERROR] 無法寫入 JSON 檔案 {path}: {e}")
@@ -85,7 +96,7 @@ def get_ai_classification(app_name: str, app_genre: str):
             model="gpt-4o-mini", # 使用最新且快速的 gpt-4o-mini 模型
             messages=[
                 {"role": "system", "content": "你是一個精準的遊戲分類專家。"},
-                {"role_name": "user", "content": prompt}
+                {"role": "user", "content": prompt}
             ],
             temperature=0, # 盡可能產生確定性的結果
             max_tokens=20 # 限制回答長度 (分類名稱通常很短)
@@ -94,12 +105,18 @@ def get_ai_classification(app_name: str, app_genre: str):
         # 取得 AI 的原始回答
         raw_response = completion.choices[0].message.content.strip()
 
+        # 常見情況：回答正好是分類名稱，或帶有提示中的序號 (例如 1. 角色扮演)，直接查表
+        matched = raw_response if raw_response in AI_CATEGORY_SET else AI_CATEGORY_NUMBERED.get(raw_response)
+        if matched:
+            print(f"[AI OK] 遊戲: {app_name} -> AI 分類: {matched}")
+            return matched
+
         # 清理並驗證回答
-        # 移除任何潛在的標點符號 (例如 1. 角色扮演)
+        # 移除任何潛在的標點符號 (例如 1.角色扮演)
         cleaned_response = re.sub(r"^\d+\.\s*", "", raw_response).strip() 
 
         # 檢查 AI 回答是否在我們的 7 種分類中
-        if cleaned_response in AI_CATEGORIES:
+        if cleaned_response in AI_CATEGORY_SET:
             print(f"[AI OK] 遊戲: {app_name} -> AI 分類: {cleaned_response}")
             return cleaned_response
         else:
@@ -118,9 +135,92 @@ def get_ai_classification(app_name: str, app_genre: str):
         print(f"[AI FATAL] 呼叫 OpenAI API 失敗: {e}。遊戲 {app_name} 強制歸類為「其他」")
         return "其他"
 
-def process_country_folder(country_folder: Path, game_type_cache: dict):
-    # === 確保 is_cache_updated 總是被初始化 ===
-    is_cache_updated = False 
+def get_ai_classifications_batch(apps: list):
+    """
+    以單一 OpenAI 請求批次取得多款遊戲的分類。
+    apps 為 [{"app_id", "app_name", "genre"}, ...]，回傳 {app_id: 分類}。
+    無法從回答中辨識的項目，會退回逐筆呼叫 get_ai_classification。
+    """
+    if not client:
+        # 如果 AI 服務失效，則全部歸類為「其他」
+        print(f"[WARN] OpenAI Client 未初始化，跳過 {len(apps)} 款遊戲的 AI 分類")
+        return {app["app_id"]: "其他" for app in apps}
+
+    app_lines = "\n".join(
+        f'{i}. "{app["app_name"]}" [{app["genre"]}]' for i, app in enumerate(apps, start=1)
+    )
+
+    # 與單筆分類相同的嚴格 Prompt，但要求依序號逐行回答
+    prompt = f"""
+    請根據以下 {len(apps)} 款遊戲的名稱和類型(Genre)，判斷每一款屬於哪一個主要分類。
+    {app_lines}
+
+    分類「只能」是以下七個選項中的「一個」：
+    角色扮演 (包含 RPG, 冒險, MMORPG)
+    社交賭場 (包含 撲克, 老虎機, 賭博, 賓果)
+    策略對戰 (包含 戰爭, 塔防, SLG, 帝國, 三國)
+    動作競技 (包含 射擊, MOBA, 格鬥, 運動, 賽車)
+    模擬沙盒 (包含 經營, 建造, 農場, 模擬器, 開放世界)
+    休閒益智 (包含 三消, 合併, 填字, 益智, 消除, 放置)
+    其他 (若以上皆非)
+
+    請依照遊戲序號逐行回答，每行格式為「序號. 分類名稱」，共 {len(apps)} 行，不要包含任何額外說明。
+    """
+
+    answers = {}
+    try:
+        completion = client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[
+                {"role": "system", "content": "你是一個精準的遊戲分類專家。"},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0,
+            max_tokens=20 * len(apps) # 每款遊戲的回答長度上限與單筆分類相同
+        )
+        raw_response = completion.choices[0].message.content.strip()
+
+        # 解析「序號. 分類名稱」格式的每一行
+        for line in raw_response.splitlines():
+            m = re.match(r"^\s*(\d+)\s*[.、:：)]\s*(.+)$", line)
+            if not m:
+                continue
+            idx = int(m.group(1))
+            if not 1 <= idx <= len(apps):
+                continue
+            answer = m.group(2).strip()
+            if answer in AI_CATEGORY_SET:
+                category = answer
+            else:
+                category = next((c for c in AI_CATEGORIES if c in answer), None)
+            if category:
+                answers[apps[idx - 1]["app_id"]] = category
+    except Exception as e:
+        print(f"[AI FATAL] 批次呼叫 OpenAI API 失敗: {e}，改為逐筆分類。")
+
+    results = {}
+    for app in apps:
+        app_id = app["app_id"]
+        if app_id in answers:
+            results[app_id] = answers[app_id]
+            print(f"[AI OK] 遊戲: {app['app_name']} -> AI 分類: {answers[app_id]}")
+        else:
+            print(f"[AI WARN] 批次回答缺少 {app['app_name']} 的分類，改為單筆呼叫。")
+            results[app_id] = get_ai_classification(app["app_name"], app["genre"])
+    return results
+
+def classified_path(json_file: Path):
+    """原始榜單對應的分類檔路徑"""
+    # 這裡使用 json_file.stem 取得沒有副檔名的部分，避免重複的 .json
+    # ios_tw_top_free_20251013 -> ios_tw_top_free_20251013_classified.json
+    return json_file.parent / f"{json_file.stem}{OUTPUT_SUFFIX}"
+
+def load_country_rank_files(country_folder: Path, overrides_mtime: float = 0):
+    """
+    載入國家資料夾中所有原始榜單檔案，回傳 [(json_file, payload), ...]
+    若分類檔比原始榜單與最近一次覆寫同步 (overrides_mtime) 都新，代表已是最新結果，直接略過不再解析。
+    """
+    rank_files = []
     
     # 使用 glob 匹配 ios_* 或 gp_* 的榜單檔案
     for json_file in sorted(country_folder.glob("*.json")):
@@ -129,77 +229,85 @@ def process_country_folder(country_folder: Path, game_type_cache: dict):
         # 這個判斷確保只處理原始榜單檔案 (ios_... 或 gp_...)
         if not json_file.name.startswith(("ios_", "gp_")):
              continue
+
+        outfile = classified_path(json_file)
+        if outfile.exists() and outfile.stat().st_mtime >= max(json_file.stat().st_mtime, overrides_mtime):
+            print(f"[SKIP] {outfile.name} 已是最新，略過。")
+            continue
         
         payload = read_json(json_file)
         if not payload:
             print(f"[WARN] 無法載入或解析 {json_file.name}，略過。")
             continue
 
-        rows = payload.get("rows", [])
-        chart = payload.get("chart", "")
-        country = payload.get("country", "")
         date_str = payload.get("date", "")
         
         try:
-            date_obj = datetime.datetime.strptime(date_str, "%Y-%m-%d").date()
+            date_obj = datetime.date.fromisoformat(date_str)
         except Exception:
             print(f"[WARN] {json_file.name} 缺少有效日期欄位，略過。")
             continue
 
-        print(f"[INFO] 正在分類排行榜檔案：{json_file.name}")
-
-        # === 進行分類 (優先使用快取/覆寫) ===
-        
-        for app in rows:
-            app_id = app.get("app_id")
-            app_name = app.get("app_name", "")
-            app_genre = app.get("genre", "")
-            
-            # 判斷 1：檢查是否在快取中 (最高優先級)
-            if app_id in game_type_cache:
-                app["ai_type"] = game_type_cache[app_id]
-            else:
-                # 判斷 2：如果不在快取中，呼叫 AI
-                print(f"[AI REQ] 新遊戲: {app_name} (ID: {app_id})，開始呼叫 AI 分類...")
-                ai_category = get_ai_classification(app_name, app_genre)
-                
-                app["ai_type"] = ai_category
-                
-                # 將 AI 的新結果存入快取，供下次使用
-                game_type_cache[app_id] = ai_category
-                is_cache_updated = True # 標記快取已被更新
-                
-                # 避免 API 呼叫過於頻繁
-                if client:
-                    time.sleep(1) 
-
-        # === 統計類型與百分比 ===
-        type_counts_raw = dict(Counter([r["genre"] for r in rows if r.get("genre")]))
-        type_counts_ai = dict(Counter([r["ai_type"] for r in rows if r.get("ai_type")]))
+        rank_files.append((json_file, payload))
         
-        total_ai_classified = sum(type_counts_ai.values())
-        type_percentages_ai = {}
-        if total_ai_classified > 0:
-            for k, v in type_counts_ai.items():
-                type_percentages_ai[k] = round(v / total_ai_classified * 100)
-
-        # === 輸出 ===
-        platform = json_file.name.split('_')[0]
-        # 這裡使用 json_file.stem 取得沒有副檔名的部分，避免重複的 .json
-        # ios_tw_top_free_20251013 -> ios_tw_top_free_20251013_classified.json
-        outfile = json_file.parent / f"{json_file.stem}_classified.json"
-        
-        payload["type_counts"] = type_counts_raw
-        payload["type_counts_ai"] = type_counts_ai
-        payload["type_percentages_ai"] = type_percentages_ai 
+    return rank_files
 
-        with open(outfile, "w", encoding="utf-8") as f:
-            json.dump(payload, f, ensure_ascii=False, indent=2)
+def classify_pending_apps(pending: dict, game_type_cache: dict):
+    """
+    將所有不在快取中的新遊戲以批次方式呼叫 AI，並將結果存入快取，供下次使用。
+    回傳快取是否有被更新。
+    """
+    if not pending:
+        return False
 
-        print(f"[OK] 已輸出分類檔案：{outfile.name}")
-        
-    # 回傳快取是否有被更新的狀態
-    return is_cache_updated
+    pending_apps = list(pending.values())
+    print(f"[AI REQ] 發現 {len(pending_apps)} 款新遊戲，開始批次呼叫 AI 分類...")
+    unsaved_count = 0 # 尚未回存的新分類筆數
+    for start in range(0, len(pending_apps), AI_BATCH_SIZE):
+        results = get_ai_classifications_batch(pending_apps[start:start + AI_BATCH_SIZE])
+        game_type_cache.update(results)
+        unsaved_count += len(results)
+
+        if unsaved_count >= CACHE_FLUSH_EVERY:
+            save_json(GAME_TYPES_CACHE_PATH, game_type_cache)
+            unsaved_count = 0
+    return True
+
+def write_classified_file(json_file: Path, payload: dict, game_type_cache: dict):
+    """依快取為榜單填入 ai_type、統計類型與百分比，並輸出 _classified.json"""
+    print(f"[INFO] 正在分類排行榜檔案：{json_file.name}")
+
+    rows = payload.get("rows", [])
+
+    # === 進行分類 (所有遊戲此時皆已在快取/覆寫中)，同一次迴圈中統計類型 ===
+    counter_raw, counter_ai = Counter(), Counter()
+    for app in rows:
+        ai_type = app["ai_type"] = game_type_cache[app.get("app_id")]
+        if app.get("genre"):
+            counter_raw[app["genre"]] += 1
+        if ai_type:
+            counter_ai[ai_type] += 1
+
+    # === 統計類型與百分比 ===
+    type_counts_raw = dict(counter_raw)
+    type_counts_ai = dict(counter_ai)
+    
+    total_ai_classified = sum(type_counts_ai.values())
+    type_percentages_ai = {}
+    if total_ai_classified > 0:
+        for k, v in type_counts_ai.items():
+            type_percentages_ai[k] = round(v / total_ai_classified * 100)
+
+    # === 輸出 ===
+    outfile = classified_path(json_file)
+    
+    payload["type_counts"] = type_counts_raw
+    payload["type_counts_ai"] = type_counts_ai
+    payload["type_percentages_ai"] = type_percentages_ai 
+
+    outfile.write_bytes(orjson.dumps(payload, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+
+    print(f"[OK] 已輸出分類檔案：{outfile.name}")
 
 def main():
     print("=== 開始使用 AI 分類排行榜檔案 ===")
@@ -217,17 +325,31 @@ def main():
     if game_type_cache:
         print(f"[INFO] 成功載入 {len(game_type_cache)} 筆遊戲類型快取/覆寫數據。")
     
-    cache_needs_saving = False # 總標記
-    
-    # 遍歷所有國家資料夾
+    # 人工覆寫改動了既有分類時，所有分類檔都需要重新產生；
+    # AI 新增的分類只涉及本次會重新輸出的榜單，不影響已略過的分類檔
+    overrides_mtime = OVERRIDES_REVISION_PATH.stat().st_mtime if OVERRIDES_REVISION_PATH.exists() else 0
+
+    # 第一階段：遍歷所有國家資料夾，載入需要 (重新) 分類的原始榜單
+    rank_files = []
     for cc_folder in RANKS_DIR.iterdir():
         # === 確保只處理資料夾，並明確跳過 'updates' 資料夾 ===
         if cc_folder.is_dir() and cc_folder.name != "updates":
-            print(f"\n--- 處理國家資料夾: {cc_folder.name} ---")
-            # 傳入快取，並接收快取是否有被更新
-            was_updated = process_country_folder(cc_folder, game_type_cache)
-            if was_updated:
-                cache_needs_saving = True
+            print(f"\n--- 載入國家資料夾: {cc_folder.name} ---")
+            rank_files.extend(load_country_rank_files(cc_folder, overrides_mtime))
+
+    # 收集所有榜單中不在快取的遊戲 (跨榜單、跨國家去重)，只呼叫一次 AI 分類
+    pending = {}
+    for _, payload in rank_files:
+        for app in payload.get("rows", []):
+            app_id = app.get("app_id")
+            if app_id not in game_type_cache and app_id not in pending:
+                pending[app_id] = {
+                    "app_id": app_id,
+                    "app_name": app.get("app_name", ""),
+                    "genre": app.get("genre", ""),
+                }
+
+    cache_needs_saving = classify_pending_apps(pending, game_type_cache)
 
     # 如果在處理過程中，AI 增加了新的分類到快取中，則執行回存
     if cache_needs_saving:
@@ -236,6 +358,10 @@ def main():
     else:
         print("\n[INFO] AI 未增加新分類，快取無需回存。")
 
+    # 第二階段：所有遊戲皆已有分類，輸出分類檔案
+    for json_file, payload in rank_files:
+        write_classified_file(json_file, payload, game_type_cache)
+
     print("✅ 所有國家 AI 分類完成")
 
 if __name__ == "__main__":
@@ -8,16 +8,21 @@ fetch_app_updates.py
   - 針對每一對日期，抓取 Top 50 遊戲版本號、更新時間、release notes。
   - 比對兩個日期，若版本號或更新時間不同則標記「改版事件」。
   - 輸出：data/ranks/updates/updates_YYYYMMDD.json (YYYYMMDD 為較新的日期)
+  - 同時輸出 metadata_cache_YYYYMMDD.json，作為下一次比對的昨日基線。
   - 只有當有實際更新事件發生時，才輸出 JSON 檔案。
 """
 
 import os
-import json
 import pathlib
 import datetime
+import threading
 import requests
 import time
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import orjson
 
 # --- 路徑與常數設定 ---
 DATA_DIR = pathlib.Path("data")
@@ -31,20 +36,99 @@ TOP_LIMIT = 50
 CHARTS = ["top_grossing", "top_free"] 
 PLATFORMS = ["ios", "gp"] # 支援 iOS 和 Google Play (GP)
 
+# --- Apple Lookup API 連線設定 ---
+LOOKUP_WORKERS = 8 # 平行查詢的執行緒數
+LOOKUP_RATE_PER_SEC = 10 # 每秒最多送出的查詢數，避免被限流
+LOOKUP_BATCH_SIZE = 150 # 單次 Lookup 請求查詢的 App 數量上限
+THROTTLE_STATUS = (429, 503) # 被限流時 Apple 回傳的狀態碼
+THROTTLE_MAX_RETRIES = 3 # 被限流時的最大重試次數
+
+# 所有查詢共用同一個 Session，重複使用 TCP/TLS 連線；伺服器暫時性錯誤由 urllib3 自動重試，
+# 限流 (429/503) 則交給 fetch_ios_metadata_batch 處理，讓所有執行緒一起退避
+SESSION = requests.Session()
+SESSION.headers.update({
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+})
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=LOOKUP_WORKERS,
+    pool_maxsize=LOOKUP_WORKERS * 2,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[500, 502, 504]),
+))
+
+class RateLimiter:
+    """
+    自適應 token bucket 限流器 (執行緒安全)，取代固定的 time.sleep。
+    被限流時速率減半並暫停所有請求，之後每次成功逐步恢復到上限。
+    """
+
+    def __init__(self, rate: float, capacity: float = None, min_rate: float = 1):
+        self.max_rate = rate
+        self.min_rate = min_rate
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """取得一個 token，不足或暫停中時等待"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    elapsed = now - max(self.last, self.paused_until)
+                    self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+                    self.last = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def success(self):
+        """請求成功：速率每次加 1，直到回到上限"""
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + 1)
+
+    def throttle(self, delay: float):
+        """被限流：速率減半、清空 token，並在 delay 秒內暫停所有請求"""
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+LOOKUP_LIMITER = RateLimiter(LOOKUP_RATE_PER_SEC)
+
 # --- 工具函式 ---
+# 已解析的 JSON 快取：{路徑: (mtime_ns, 資料)}，同一檔案在一次執行中只解析一次 (呼叫端不可修改回傳值)
+_JSON_CACHE = {}
+
 def read_json(path):
     """安全讀取 JSON 檔案，不存在或錯誤則回傳空字典"""
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
+        key = str(path)
+        mtime = os.stat(path).st_mtime_ns
+        cached = _JSON_CACHE.get(key)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        with open(path, "rb") as f:
+            data = orjson.loads(f.read())
+        _JSON_CACHE[key] = (mtime, data)
+        return data
     except Exception:
         return {}
 
 def write_json(path, data):
-    """安全寫入 JSON 檔案"""
+    """安全寫入 JSON 檔案 (先寫入暫存檔再以 os.replace 原子性替換，避免中斷時留下殘缺檔案)"""
+    _JSON_CACHE.pop(str(path), None)
     try:
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        tmp_path = path.with_suffix(path.suffix + ".tmp")
+        # 非字串鍵 (若有) 亦會轉為字串
+        tmp_path.write_bytes(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+        os.replace(tmp_path, path)
     except Exception as e:
         print(f"[FATAL ERROR] 無法寫入 JSON 檔案 {path}: {e}")
 
@@ -63,53 +147,70 @@ def load_rank_data(country: str, date_str: str, chart: str, platform: str):
     fpath = folder / filename
     return read_json(fpath)
 
-def fetch_ios_metadata(app_id):
-    """呼叫 Apple Lookup API 抓版本、更新時間、release notes"""
+def retry_after_seconds(r, attempt: int) -> float:
+    """讀取 Retry-After (秒數)，並與指數退避 (1, 2, 4... 秒) 取較大者；無法解析時只用指數退避"""
+    backoff = 2 ** attempt
     try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-        url = f"https://itunes.apple.com/lookup?id={app_id}"
-        r = requests.get(url, timeout=10, headers=headers)
+        return max(float(r.headers.get("Retry-After", 0)), backoff)
+    except (TypeError, ValueError):
+        return backoff
+
+def fetch_ios_metadata_batch(app_ids, session=SESSION):
+    """
+    呼叫 Apple Lookup API 抓版本、更新時間、release notes。
+    Lookup API 接受以逗號分隔的多個 id，一次請求查詢一批 App，回傳 {app_id: info}。
+    被限流 (429/503) 時依 Retry-After 退避後重試，最多 THROTTLE_MAX_RETRIES 次。
+    """
+    try:
+        url = f"https://itunes.apple.com/lookup?id={','.join(app_ids)}"
+        for attempt in range(THROTTLE_MAX_RETRIES + 1):
+            LOOKUP_LIMITER.acquire()
+            r = session.get(url, timeout=10)
+            if r.status_code not in THROTTLE_STATUS or attempt == THROTTLE_MAX_RETRIES:
+                break
+            delay = retry_after_seconds(r, attempt)
+            print(f"[WARN] Lookup 被限流 (HTTP {r.status_code})，{delay:.0f} 秒後重試 ({attempt + 1}/{THROTTLE_MAX_RETRIES})")
+            LOOKUP_LIMITER.throttle(delay)
 
         if r.status_code != 200:
-            return None
-
-        js = r.json()
-        if not js.get("results"):
-            return None
-        item = js["results"][0]
-        return {
-            "version": item.get("version"),
-            "updated": item.get("currentVersionReleaseDate"),
-            "releaseNotes": item.get("releaseNotes", ""),
-            "app_id": str(app_id)
-        }
+            return {}
+        LOOKUP_LIMITER.success()
+
+        results = {}
+        for item in orjson.loads(r.content).get("results", []):
+            app_id = str(item.get("trackId", ""))
+            results[app_id] = {
+                "version": item.get("version"),
+                "updated": item.get("currentVersionReleaseDate"),
+                "releaseNotes": item.get("releaseNotes", ""),
+                "app_id": app_id
+            }
+        return results
     except Exception as e:
-        print(f"[ERROR] fetch_ios_metadata {app_id}: {e}")
-        return None
+        print(f"[ERROR] fetch_ios_metadata_batch ({len(app_ids)} apps): {e}")
+        return {}
 
 def detect_updates(today_data, yesterday_data):
     """
     比對今日與昨日版本差異。
     today_data / yesterday_data 的結構皆為 {app_name: {version, updated, ...}}
     """
+    # 沒有昨日基準 (例如當天第一次執行) 時不可能有更新事件
+    if not yesterday_data:
+        return {}
+
     updates = {}
     for app_name, today_info in today_data.items():
         y_info = yesterday_data.get(app_name)
         if not y_info:
             continue
         # 判斷版本號或更新時間是否不同
-        if (
-            today_info.get("version") != y_info.get("version")
-            or today_info.get("updated") != y_info.get("updated")
-        ):
-            updates[app_name] = dict(today_info)
-            updates[app_name]["event"] = "版本更新"
+        if (today_info.get("version"), today_info.get("updated")) != (y_info.get("version"), y_info.get("updated")):
+            updates[app_name] = {**today_info, "event": "版本更新"}
     return updates
 
-def process_date_pair(country, platform, chart, today_str, yday_str):
-    """處理單一國家、平台、榜單的特定日期比對"""
+def collect_top_apps(country, platform, chart, today_str, yday_str):
+    """載入單一國家、平台、榜單的日期對，回傳需要查詢版本資訊的 {app_id: app_name}"""
     
     # 1. 載入今日與昨日榜單資料
     today_rank_data = load_rank_data(country, today_str, chart, platform)
@@ -117,8 +218,7 @@ def process_date_pair(country, platform, chart, today_str, yday_str):
     
     if not today_rank_data or not yesterday_rank_data:
         print(f"[WARN] {country} {platform.upper()} {chart}: 缺少 {today_str} 或 {yday_str} 榜單資料，跳過。")
-        # [修正 1] 確保在缺少榜單資料時回傳兩個值
-        return {}, {} 
+        return {}
     
     # 2. 確定需要查詢版本資訊的 App ID 集合 (Top Limit)
     union_apps = {}
@@ -130,20 +230,32 @@ def process_date_pair(country, platform, chart, today_str, yday_str):
         if app_id and app_name:
             union_apps[str(app_id)] = app_name
 
+    return union_apps
+
+def fetch_ios_metadata_all(app_ids):
+    """將 App ID 分批，每批一次請求；多批時以執行緒池平行查詢，請求速率由 LOOKUP_LIMITER 控制"""
+    batches = [app_ids[i:i + LOOKUP_BATCH_SIZE] for i in range(0, len(app_ids), LOOKUP_BATCH_SIZE)]
+    metadata = {}
+    with ThreadPoolExecutor(max_workers=LOOKUP_WORKERS) as executor:
+        for batch_result in executor.map(fetch_ios_metadata_batch, batches):
+            metadata.update(batch_result)
+    return metadata
+
+def process_date_pair(platform, union_apps, metadata_cache, yesterday_update_data):
+    """
+    處理單一國家、平台、榜單的特定日期比對。
+    版本資訊已事先統一查詢並存於 metadata_cache ({app_id: info})，
+    昨日基線 (yesterday_update_data) 也由呼叫端事先讀好，這裡只做比對，不發出任何請求也不讀檔。
+    """
     if not union_apps:
-        # [修正 2] 確保在 App 集合為空時回傳兩個值
         return {}, {} 
         
-    # 3. 載入昨日已儲存的版本資料 (作為比對基線)
-    yday_file = UPDATE_DIR / f"updates_{yday_str}.json"
-    yesterday_update_data = read_json(yday_file).get(country, {}).get(platform, {}).get(chart, {})
-    
-    # 4. 查詢最新版本資訊 (Today's Metadata)
+    # 4. 組成最新版本資訊 (Today's Metadata)
     today_data = {}
-    for i, (app_id, app_name) in enumerate(union_apps.items(), start=1):
-        if platform == "ios":
-            
-            info = fetch_ios_metadata(app_id)
+    if platform == "ios":
+        # 依榜單順序組成結果，確保輸出 JSON 的順序固定
+        for app_id, app_name in union_apps.items():
+            info = metadata_cache.get(app_id)
             if not info:
                 continue
                 
@@ -153,10 +265,9 @@ def process_date_pair(country, platform, chart, today_str, yday_str):
                 "releaseNotes": info.get("releaseNotes", ""),
                 "app_id": info.get("app_id")
             }
-            time.sleep(0.3)  # 避免請求過快被限流
-        else:
-            # TODO: 接入 Google Play 版本查詢 API
-            pass
+    else:
+        # TODO: 接入 Google Play 版本查詢 API
+        pass
 
     # 5. 比較版本差異
     updates = detect_updates(today_data, yesterday_update_data)
@@ -164,16 +275,26 @@ def process_date_pair(country, platform, chart, today_str, yday_str):
     # 6. 回傳偵測到的更新，以及今天查詢到的版本資訊 (作為下一次比較的基準)
     return updates, today_data
 
+def group_by_date(flat_results):
+    """將 {(date, country, platform, chart): value} 組成 {date: {country: {platform: {chart: value}}}}"""
+    grouped = {}
+    for (today_str, country, platform, chart), value in flat_results.items():
+        grouped.setdefault(today_str, {}).setdefault(country, {}).setdefault(platform, {})[chart] = value
+    return grouped
+
 def main():
     
-    # 儲存所有日期對的結果，結構：{today_str: {country: {platform: {chart: updates}}}}
-    all_results = defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: defaultdict(dict))))
+    # 儲存所有日期對的結果，扁平結構：{(today_str, country, platform, chart): updates}
+    all_results = {}
     
-    # 儲存所有日期對的版本基準資料，結構：{today_str: {country: {platform: {chart: today_metadata}}}}
-    all_metadata = defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: defaultdict(dict))))
+    # 儲存所有日期對的版本基準資料，扁平結構：{(today_str, country, platform, chart): today_metadata}
+    all_metadata = {}
     
     print("=== 開始偵測版本更新事件 ===")
     
+    # 第一階段：收集所有 (國家, 平台, 榜單, 日期對) 需要查詢的 App
+    groups = []
+    
     # 修正: 讀取所有目標國家
     for country in TARGET_COUNTRIES:
         
@@ -196,50 +317,68 @@ def main():
                     continue 
                 
                 for chart in CHARTS:
-                    
-                    # 這裡 process_date_pair 必須回傳兩個值
-                    updates, today_metadata = process_date_pair(country, platform, chart, today_str, yday_str)
-                    
-                    # 儲存偵測結果 (updates)
-                    if updates:
-                        all_results[today_str][country][platform][chart] = updates
-                        print(f"[OK] {country} {platform.upper()} {chart} ({today_str} vs {yday_str}): 偵測到 {len(updates)} 筆更新。")
-                    else:
-                        print(f"[INFO] {country} {platform.upper()} {chart} ({today_str} vs {yday_str}): 無更新。")
-                        
-                    # 儲存版本資訊 (metadata) - 作為下次比較的基準
-                    if today_metadata:
-                        all_metadata[today_str][country][platform][chart] = today_metadata
-
-    # 3. 輸出結果與基準檔案
+                    union_apps = collect_top_apps(country, platform, chart, today_str, yday_str)
+                    groups.append((country, platform, chart, today_str, yday_str, union_apps))
+
+    # 第二階段：同一款 App 常同時出現在多個榜單與國家，先去重後統一查詢一次
+    ios_app_ids = list(dict.fromkeys(
+        app_id
+        for country, platform, chart, today_str, yday_str, union_apps in groups
+        if platform == "ios"
+        for app_id in union_apps
+    ))
+    print(f"\n[INFO] 共 {len(ios_app_ids)} 款不重複的 iOS App，開始查詢版本資訊...")
+    metadata_cache = fetch_ios_metadata_all(ios_app_ids)
+
+    # 昨日基線：每個日期的 metadata_cache_YYYYMMDD.json 只讀取一次
+    # (updates_ 檔只記錄有變動的 App，不能當作完整的比對基線)
+    yday_metadata = {
+        yday_str: read_json(UPDATE_DIR / f"metadata_cache_{yday_str}.json")
+        for country, platform, chart, today_str, yday_str, union_apps in groups
+    }
+
+    # 第三階段：純比對，不再發出任何請求
+    for country, platform, chart, today_str, yday_str, union_apps in groups:
+        yesterday_update_data = yday_metadata[yday_str].get(country, {}).get(platform, {}).get(chart, {})
+        
+        # 這裡 process_date_pair 必須回傳兩個值
+        updates, today_metadata = process_date_pair(
+            platform, union_apps, metadata_cache, yesterday_update_data
+        )
+        
+        # 儲存偵測結果 (updates)
+        if updates:
+            all_results[(today_str, country, platform, chart)] = updates
+            print(f"[OK] {country} {platform.upper()} {chart} ({today_str} vs {yday_str}): 偵測到 {len(updates)} 筆更新。")
+        else:
+            print(f"[INFO] {country} {platform.upper()} {chart} ({today_str} vs {yday_str}): 無更新。")
+            
+        # 儲存版本資訊 (metadata) - 作為下次比較的基準
+        if today_metadata:
+            all_metadata[(today_str, country, platform, chart)] = today_metadata
+
+    # 3. 依日期組成輸出結構：{today_str: {country: {platform: {chart: ...}}}}
+    # all_results 只收錄有更新事件的榜單，因此出現在 updates_by_date 的日期即代表有實際更新
+    updates_by_date = group_by_date(all_results)
+    metadata_by_date = group_by_date(all_metadata)
+
+    # 輸出結果與基準檔案
     generated_files = []
     
     # 遍歷所有有更新或有新 metadata 的日期
-    for today_str in sorted(all_results.keys() | all_metadata.keys()):
-        
-        country_updates = all_results.get(today_str, {})
+    for today_str in sorted(updates_by_date.keys() | metadata_by_date.keys()):
         
-        # 檢查該日期是否有任何實際的更新事件
-        has_updates = any(chart_updates for country_updates in country_updates.values() 
-                          for platform_updates in country_updates.values()
-                          for chart_updates in platform_updates.values())
-
-        if has_updates:
+        if today_str in updates_by_date:
             # 輸出更新偵測結果 (updates_YYYYMMDD.json)
             out_updates_path = UPDATE_DIR / f"updates_{today_str}.json"
-            
-            # 將 defaultdict 轉換為標準 dict 輸出
-            final_updates_result = json.loads(json.dumps(country_updates))
-            
-            write_json(out_updates_path, final_updates_result)
+            write_json(out_updates_path, updates_by_date[today_str])
             generated_files.append(out_updates_path.name)
             
         # 同時將該日期的版本資訊（Metadata）寫入，作為下次執行的「昨日」基準
         # 即使沒有 updates，只要有 metadata 就要寫入，確保下一次比較有基準
-        if all_metadata[today_str]:
+        if today_str in metadata_by_date:
             out_metadata_path = UPDATE_DIR / f"metadata_cache_{today_str}.json"
-            final_metadata_result = json.loads(json.dumps(all_metadata[today_str]))
-            write_json(out_metadata_path, final_metadata_result)
+            write_json(out_metadata_path, metadata_by_date[today_str])
 
 
     print("\n=== Summary ===")
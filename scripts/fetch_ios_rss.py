@@ -1,5 +1,8 @@
-import json, datetime, pathlib, requests
+import os, datetime, pathlib, requests
 from collections import defaultdict, Counter
+from functools import lru_cache
+
+import orjson
 
 # === Google Sheet 設定 ===
 SHEET_ID = "1R-F71n6UVU528QVZmqmRLLgwmQUQpr6TtnBSwkjPG24"
@@ -10,39 +13,62 @@ API_URL = f"https://opensheet.elk.sh/{SHEET_ID}/{SHEET_NAME}"
 DATA_DIR = pathlib.Path("data")
 RANKS_DIR = DATA_DIR / "ranks"
 LATEST_DIR = DATA_DIR / "latest"
+# 上次抓取 Google Sheet 時的 ETag / Last-Modified，用於條件式請求
+SHEET_CACHE_META_PATH = DATA_DIR / ".sheet_cache_meta.json"
 RANKS_DIR.mkdir(parents=True, exist_ok=True)
 LATEST_DIR.mkdir(parents=True, exist_ok=True)
 
+# 以下三個函式每列資料都會呼叫，但輸入值種類很少，以 lru_cache 快取結果
+@lru_cache(maxsize=256)
 def safe_int(v, default=0):
     try:
         return int(float(v))
     except Exception:
         return default
 
+# 榜單類型關鍵字規則 (依序比對，先命中者為準)
+CHART_RULES = (
+    (("免費", "免费", "free"), "top_free"),
+    (("暢銷", "畅销", "營收", "grossing", "revenue"), "top_grossing"),
+)
+
+@lru_cache(maxsize=256)
 def normalize_chart(chart_name):
     """辨識榜單類型（支援繁中、簡中、英文）"""
     name = str(chart_name).lower()
-    if any(k in name for k in ["免費", "免费", "free"]):
-        return "top_free"
-    elif any(k in name for k in ["暢銷", "畅销", "營收", "grossing", "revenue"]):
-        return "top_grossing"
-    else:
-        return "top_other"
+    for keywords, chart in CHART_RULES:
+        if any(k in name for k in keywords):
+            return chart
+    return "top_other"
 
+@lru_cache(maxsize=256)
 def normalize_country(cc):
     cc = str(cc).strip().upper()
     return cc if cc else "TW"
 
+# parse_date 依序嘗試的日期格式
+DATE_FORMATS = ("%Y/%m/%d", "%Y-%m-%d", "%Y/%m/%d %H:%M:%S", "%Y-%m-%d %H:%M:%S")
+
 def parse_date(date_str):
     """多格式日期解析"""
     s = str(date_str).strip()
-    for fmt in ("%Y/%m/%d", "%Y-%m-%d", "%Y/%m/%d %H:%M:%S", "%Y-%m-%d %H:%M:%S"):
+    # YYYY-MM-DD 先走 fromisoformat 的快速路徑，其餘格式 (含最常見的 YYYY/MM/DD) 直接交給 strptime，
+    # 避免每列都先丟出並捕捉一次 ValueError
+    if len(s) == 10 and s[4] == "-" and s[7] == "-":
+        try:
+            return datetime.date.fromisoformat(s)
+        except ValueError:
+            pass
+    for fmt in DATE_FORMATS:
         try:
             return datetime.datetime.strptime(s, fmt).date()
         except Exception:
             continue
     return None
 
+# 已解析的 JSON 快取：{路徑: (mtime_ns, 資料)}，同一檔案在一次執行中只解析一次 (呼叫端不可修改回傳值)
+_JSON_CACHE = {}
+
 def read_json(path, default_value=None):
     """
     安全讀取 JSON 檔案，不存在或錯誤則回傳預設值。
@@ -52,8 +78,15 @@ def read_json(path, default_value=None):
         default_value = {}
         
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
+        key = str(path)
+        mtime = os.stat(path).st_mtime_ns
+        cached = _JSON_CACHE.get(key)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        with open(path, "rb") as f:
+            data = orjson.loads(f.read())
+        _JSON_CACHE[key] = (mtime, data)
+        return data
     except Exception:
         return default_value
 
@@ -100,6 +133,24 @@ def load_prev_rank(platform, country, chart, date_obj):
     # 建立 app_id 到 rank 的映射
     return {r["app_id"]: r["rank"] for r in prev_data.get("rows", [])}
 
+def write_if_changed(path, buf):
+    """
+    僅在內容與現有檔案不同時才寫入，避免無意義的檔案異動 (以及後續的空 git commit)。
+    先比對檔案大小，大小相同時才讀取內容比對。回傳是否有寫入。
+    寫入時先寫暫存檔再以 os.replace 原子性替換，中斷時不會留下殘缺檔案。
+    """
+    try:
+        if os.stat(path).st_size == len(buf):
+            with open(path, "rb") as f:
+                if f.read() == buf:
+                    return False
+    except OSError:
+        pass
+    _JSON_CACHE.pop(str(path), None)
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    tmp_path.write_bytes(buf)
+    os.replace(tmp_path, path)
+    return True
 
 def write_json(platform, country, chart, date_obj, rows, type_counts):
     """輸出單一榜單 JSON 檔案"""
@@ -118,14 +169,16 @@ def write_json(platform, country, chart, date_obj, rows, type_counts):
 
     filename = f"{platform.lower()}_{country.lower()}_{chart}_{date_str}.json"
     filepath = folder / filename
-    with open(filepath, "w", encoding="utf-8") as f:
-        json.dump(payload, f, ensure_ascii=False, indent=2)
-    print(f"[OK] {filepath} ({len(rows)} rows)")
+    # 只序列化一次，同一份 bytes 寫入榜單檔與最新榜單
+    buf = orjson.dumps(payload, option=orjson.OPT_INDENT_2)
+    if write_if_changed(filepath, buf):
+        print(f"[OK] {filepath} ({len(rows)} rows)")
+    else:
+        print(f"[SKIP] {filepath} 內容未變動 ({len(rows)} rows)")
 
     # 寫出最新榜單 (LATEST_DIR)
     latest = LATEST_DIR / f"{platform.lower()}_{country.lower()}_{chart}.json"
-    with open(latest, "w", encoding="utf-8") as f:
-        json.dump(payload, f, ensure_ascii=False, indent=2)
+    write_if_changed(latest, buf)
     return date_str
 
 def update_available_dates(country, new_date):
@@ -134,37 +187,48 @@ def update_available_dates(country, new_date):
     folder.mkdir(parents=True, exist_ok=True) 
     path = folder / f"available_dates_{country}.json"
 
-    # [修正] 確保 dates 是一個列表
-    dates = read_json(path, default_value=[]) 
+    dates = read_json(path, default_value=[])
+    # 檔案由本函式寫出，本來就已去重並排序；日期已存在時無需重新排序與寫檔
+    if new_date in dates:
+        return
 
-    if new_date not in dates:
-        dates.insert(0, new_date)
-    # 保持排序「新到舊」
-    dates = sorted(set(dates), reverse=True)
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(dates[:50], f, ensure_ascii=False, indent=2)
-    print(f"[OK] available_dates_{country}.json updated at {path}")
+    # 保持排序「新到舊」(sorted 產生新列表，不會修改到快取中的資料)
+    dates = sorted({*dates, new_date}, reverse=True)
+    if write_if_changed(path, orjson.dumps(dates[:50], option=orjson.OPT_INDENT_2)):
+        print(f"[OK] available_dates_{country}.json updated at {path}")
 
 def fetch_and_generate():
     print(f"[INFO] Fetching JSON from: {API_URL}")
-    r = requests.get(API_URL, timeout=30)
-    r.raise_for_status()
-    data = r.json()
-    print(f"[INFO] Loaded {len(data)} rows")
 
-    # 先找出資料內所有有效日期
-    all_dates = [parse_date(row.get("日期", "")) for row in data if parse_date(row.get("日期", ""))]
-    if not all_dates:
-        print("⚠️ 無有效日期欄位，請確認 Google Sheet。")
+    # 帶上次回應的 ETag / Last-Modified 做條件式請求，資料未變動時伺服器回傳 304
+    cache_meta = read_json(SHEET_CACHE_META_PATH)
+    headers = {}
+    if cache_meta.get("etag"):
+        headers["If-None-Match"] = cache_meta["etag"]
+    if cache_meta.get("last_modified"):
+        headers["If-Modified-Since"] = cache_meta["last_modified"]
+
+    r = requests.get(API_URL, headers=headers, timeout=30)
+    if r.status_code == 304:
+        print("[INFO] Google Sheet 資料未變動 (HTTP 304)，略過解析與輸出。")
         return
-    latest_date = max(all_dates)
-    print(f"[INFO] 最新日期為：{latest_date}")
+    r.raise_for_status()
+    new_cache_meta = {
+        "etag": r.headers.get("ETag"),
+        "last_modified": r.headers.get("Last-Modified"),
+    }
+    data = orjson.loads(r.content)
+    print(f"[INFO] Loaded {len(data)} rows")
 
+    # 單次遍歷：每列只解析一次日期，同時找出最新日期並分組
+    latest_date = None
     grouped = defaultdict(list)
     for row in data:
         date_obj = parse_date(row.get("日期", ""))
         if not date_obj:
             continue
+        if latest_date is None or date_obj > latest_date:
+            latest_date = date_obj
 
         platform = row.get("平台", "iOS")
         country = normalize_country(row.get("國家", "TW"))
@@ -204,6 +268,14 @@ def fetch_and_generate():
             "ai_type": None,
         })
 
+    # 原始回應與解析後的列表已整理進 grouped，提早釋放，避免輸出階段同時持有兩份資料
+    del data, r
+
+    if latest_date is None:
+        print("⚠️ 無有效日期欄位，請確認 Google Sheet。")
+        return
+    print(f"[INFO] 最新日期為：{latest_date}")
+
     if not grouped:
         print("⚠️ No valid groups found. Please check sheet columns.")
         return
@@ -212,19 +284,21 @@ def fetch_and_generate():
 
     # 第二階段：計算 delta 並輸出 JSON
     for (platform, country, chart, date_obj), rows in grouped.items():
-        rows = sorted(rows, key=lambda x: x["rank"] or 9999)
-        type_counts = dict(Counter([r["genre"] for r in rows if r["genre"]]))
-
-        # --- 新增 Delta 計算邏輯 ---
-        prev_rank_map = load_prev_rank(platform, country, chart, date_obj)
-        if prev_rank_map:
-            for r in rows:
-                aid = r["app_id"]
-                current_rank = r["rank"]
-                prev_rank = prev_rank_map.get(aid)
-                
-                if prev_rank and current_rank:
-                    r["delta"] = prev_rank - current_rank
+        rows.sort(key=lambda x: x["rank"] or 9999)
+
+        # --- 新增 Delta 計算邏輯 (與類型統計在同一次遍歷中完成) ---
+        prev_rank_map = load_prev_rank(platform, country, chart, date_obj) or {}
+        genre_counter = Counter()
+        for r in rows:
+            if r["genre"]:
+                genre_counter[r["genre"]] += 1
+
+            current_rank = r["rank"]
+            prev_rank = prev_rank_map.get(r["app_id"])
+            
+            if prev_rank and current_rank:
+                r["delta"] = prev_rank - current_rank
+        type_counts = dict(genre_counter)
         
         # 必須在計算完 delta 後再更新 available_dates，否則 load_prev_rank 會出錯
         date_str = date_obj.strftime("%Y%m%d")
@@ -233,6 +307,9 @@ def fetch_and_generate():
         write_json(platform, country, chart, date_obj, rows, type_counts)
         generated_dates.add((country, date_str))
 
+    # 全部輸出成功後才記錄本次回應的快取標頭，避免中途失敗時下次被 304 略過
+    write_if_changed(SHEET_CACHE_META_PATH, orjson.dumps(new_cache_meta, option=orjson.OPT_INDENT_2))
+
     print("\n=== Summary ===")
     for cc, dt in sorted(generated_dates):
         print(f"[OK] {cc} - {dt}")
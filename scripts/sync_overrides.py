@@ -8,10 +8,11 @@ sync_overrides.py
 """
 
 import os
-import json
 import datetime
+import orjson
 import firebase_admin
 from firebase_admin import credentials, firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
 
 # === Firestore 初始化 ===
 CRED_PATH = os.getenv("FIREBASE_CRED_JSON", "firebase_key.json")
@@ -27,38 +28,74 @@ db = firestore.client()
 # === 路徑設定 ===
 DATA_DIR = "data"
 GAME_TYPES_PATH = os.path.join(DATA_DIR, "game_types.json")
+# 上次同步時看到的最新 updated_at，下次只撈取在此之後修改過的覆寫
+SYNC_STATE_PATH = os.path.join(DATA_DIR, ".overrides_sync.json")
+# 只在覆寫實際改動既有分類時重寫；classify_games.py 依其修改時間判斷分類檔是否需要重新產生
+OVERRIDES_REVISION_PATH = os.path.join(DATA_DIR, ".overrides_revision.json")
 os.makedirs(DATA_DIR, exist_ok=True)
 
 def load_local_game_types():
     if not os.path.exists(GAME_TYPES_PATH):
         return {}
-    with open(GAME_TYPES_PATH, "r", encoding="utf-8") as f:
+    with open(GAME_TYPES_PATH, "rb") as f:
         try:
-            return json.load(f)
+            return orjson.loads(f.read())
         except Exception:
             return {}
 
 def save_game_types(data):
-    with open(GAME_TYPES_PATH, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    with open(GAME_TYPES_PATH, "wb") as f:
+        f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
 
-def fetch_overrides():
-    """從 Firebase 撈取 override 類別"""
+def load_sync_state():
+    """讀取上次同步到的最新 updated_at，沒有紀錄則回傳 None (代表需要完整同步)"""
+    try:
+        with open(SYNC_STATE_PATH, "rb") as f:
+            return datetime.datetime.fromisoformat(orjson.loads(f.read())["updated_at"])
+    except Exception:
+        return None
+
+def save_sync_state(updated_at):
+    with open(SYNC_STATE_PATH, "wb") as f:
+        f.write(orjson.dumps({"updated_at": updated_at.isoformat()}, option=orjson.OPT_INDENT_2))
+
+def save_overrides_revision(updated):
+    with open(OVERRIDES_REVISION_PATH, "wb") as f:
+        f.write(orjson.dumps({
+            "synced_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "updated": updated,
+        }, option=orjson.OPT_INDENT_2))
+
+def fetch_overrides(since=None):
+    """
+    從 Firebase 撈取 override 類別。
+    指定 since 時只撈取 updated_at 晚於該時間的文件，避免每次讀取整個集合。
+    回傳 (overrides, 本次看到的最新 updated_at)。
+    """
     overrides = {}
-    docs = db.collection("overrides").stream()
-    for doc in docs:
+    latest_updated_at = since
+    # stream() 本身已是單一串流請求；只取同步需要的欄位，減少傳輸量
+    query = db.collection("overrides").select(["app_id", "category", "updated_at"])
+    if since is not None:
+        query = query.where(filter=FieldFilter("updated_at", ">", since))
+    for doc in query.stream():
         d = doc.to_dict()
         app_id = str(d.get("app_id") or "").strip()
         category = str(d.get("category") or "").strip()
         if app_id and category:
             overrides[app_id] = category
-    print(f"[INFO] 從 Firebase 撈取 {len(overrides)} 筆覆寫資料")
-    return overrides
+        updated_at = d.get("updated_at")
+        if updated_at and (latest_updated_at is None or updated_at > latest_updated_at):
+            latest_updated_at = updated_at
+    mode = f"增量 (自 {since.isoformat()} 起)" if since else "完整"
+    print(f"[INFO] 從 Firebase {mode}撈取 {len(overrides)} 筆覆寫資料")
+    return overrides, latest_updated_at
 
 def main():
     print("[INFO] 開始同步 Firebase overrides ...")
     local_types = load_local_game_types()
-    overrides = fetch_overrides()
+    since = load_sync_state()
+    overrides, latest_updated_at = fetch_overrides(since)
 
     updated = 0
     for app_id, new_cat in overrides.items():
@@ -67,7 +104,12 @@ def main():
             local_types[app_id] = new_cat
             updated += 1
 
-    save_game_types(local_types)
+    # 沒有任何變動時不重寫 game_types.json 與 revision 標記，讓下游的分類檔保持有效
+    if updated:
+        save_game_types(local_types)
+        save_overrides_revision(updated)
+    if latest_updated_at and latest_updated_at != since:
+        save_sync_state(latest_updated_at)
     print(f"[OK] 已更新 {updated} 筆覆寫資料，共 {len(local_types)} 筆快取。")
     print(f"[TIME] {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} 完成同步。")
 